@@ -1,11 +1,35 @@
+import atexit
 import ee
-import json
+import logging
+import msgspec
+import orjson
 import os
-import traceback
-from flask import Flask, render_template, request, jsonify
+import queue
+import requests
+import socket
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from flask import Flask, Response, render_template, request
 from flask_cors import CORS
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import date, datetime, timedelta
+from logging.handlers import QueueHandler, QueueListener
+from requests.adapters import HTTPAdapter
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import BaseConverter
+from typing import Annotated, Literal
+
+from ee_pipeline import (
+    BAND_CONFIGS,
+    EE_TILES_BASE,
+    MOSAIC_METHODS,
+    build_multiband_tiles,
+    build_tiles,
+    image_stats,
+    initialize_earth_engine
+)
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -17,188 +41,456 @@ CORS(app)  # Разрешаем запросы с любых доменов
 # Конфигурация
 DEBUG = os.environ.get("DEBUG", "False").lower() == "true"
 
-def initialize_earth_engine():
-    """Инициализация Earth Engine"""
-    try:
-        print("\n🔄 Инициализация Earth Engine...")
-        
-        # Получаем credentials из переменных окружения (GitHub Secrets)
-        gee_credentials = os.environ.get("GEE_CREDENTIALS")
-        
-        if not gee_credentials:
-            raise ValueError("GEE_CREDENTIALS не найдены в переменных окружения")
-        
-        # Парсим JSON credentials
-        service_account_info = json.loads(gee_credentials)
-        
-        # Создаем credentials для Earth Engine
-        credentials = ee.ServiceAccountCredentials(
-            service_account_info["client_email"],
-            key_data=json.dumps(service_account_info)
+# Логирование через очередь: запись в stderr выполняет фоновый поток
+logger = logging.getLogger("krusgis")
+logger.setLevel(logging.DEBUG if DEBUG else logging.INFO)
+logger.propagate = False
+
+_log_queue = queue.Queue(-1)
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+_log_listener = QueueListener(_log_queue, _log_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+logger.addHandler(QueueHandler(_log_queue))
+
+# Кэш тайлов: время жизни (сек) и максимальное число записей
+TILE_CACHE_TTL = int(os.environ.get("TILE_CACHE_TTL", 3600))
+TILE_CACHE_SIZE = int(os.environ.get("TILE_CACHE_SIZE", 512))
+
+# Точность округления границ по умолчанию (4 знака ≈ 11 м)
+BOUNDS_PRECISION = 4
+
+# Таймаут одного HTTP-запроса к Earth Engine (сек)
+EE_TIMEOUT = int(os.environ.get("EE_TIMEOUT", 60))
+
+# Размер пулов соединений (Earth Engine и прокси тайлов) - по числу
+# одновременных запросов воркера
+TILE_POOL_SIZE = int(os.environ.get("WORKER_CONCURRENCY", 32))
+
+_tile_cache = OrderedDict()
+_tile_cache_lock = threading.Lock()
+
+# Выполняющиеся запросы к Earth Engine по ключу кэша
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+# Проксирование тайлов через /tiles/... (для размещения за CDN)
+TILE_PROXY = os.environ.get("TILE_PROXY", "False").lower() == "true"
+
+# Публичный адрес прокси (например, https://tiles.example.com за CDN).
+# Без него берется адрес запроса, а за обратным прокси это внутренний хост
+TILE_PROXY_BASE_URL = os.environ.get("TILE_PROXY_BASE_URL", "").rstrip("/")
+
+# Тайлы одного mapid не меняются - браузер и CDN могут хранить их сутки
+TILE_CACHE_CONTROL = "public, max-age=86400, immutable"
+
+# Срок годности ответа API с URL тайлов. Ответы на POST браузеры и CDN
+# не переиспользуют, заголовок носит справочный характер: он сообщает
+# клиенту, сколько живет запись в нашем кэше
+API_CACHE_CONTROL = f"public, max-age={TILE_CACHE_TTL}"
+
+_tile_session = requests.Session()
+_tile_session.mount("https://", HTTPAdapter(pool_maxsize=TILE_POOL_SIZE))
+
+class ImageStatsRequest(msgspec.Struct):
+    """Параметры выборки снимков"""
+    bounds: Annotated[list[float], msgspec.Meta(min_length=4, max_length=4)]
+    start_date: date
+    end_date: date
+    cloud_filter: Annotated[int, msgspec.Meta(ge=0, le=100)] = 30
+    nocache: bool = False
+    precision: Annotated[int, msgspec.Meta(ge=0, le=8)] = BOUNDS_PRECISION
+    snap_dates: bool = True
+
+class MosaicRequest(ImageStatsRequest):
+    """Параметры построения мозаики"""
+    smoothing: bool = True
+    mosaic_method: Literal[MOSAIC_METHODS] = 'median'
+
+class TileRequest(MosaicRequest):
+    """Параметры запроса тайлов одного слоя"""
+    layer: Literal[tuple(BAND_CONFIGS)] = 'TRUE_COLOR'
+
+def normalize_selection(params):
+    """Приведение области и периода к сетке
+    
+    Близкие окна карты и даты дают одинаковые параметры мозаики, поэтому
+    повторно используются и наш кэш, и кэш тайлов Earth Engine. Период
+    расширяется до целых недель с понедельника (конец не включается).
+    """
+    bounds = [round(v, params.precision) for v in params.bounds]
+    
+    # Слишком грубое округление схлопывает окно карты в линию или точку
+    xmin, ymin, xmax, ymax = bounds
+    if not (xmin < xmax and ymin < ymax):
+        raise msgspec.ValidationError(
+            f"Границы {bounds} вырождены при precision={params.precision}"
         )
-        
-        # Инициализируем Earth Engine
-        ee.Initialize(credentials)
-        print("✅ Earth Engine инициализирован")
-        return True
-        
-    except Exception as e:
-        print(f"❌ Ошибка инициализации Earth Engine: {str(e)}")
-        return False
-
-def mask_clouds(img):
-    """Маскировка облаков"""
-    scl = img.select("SCL")
-    allowed = scl.eq(4).Or(scl.eq(5)).Or(scl.eq(6)).Or(scl.eq(7))
-    return img.updateMask(allowed).resample("bilinear")
-
-def calculate_ndvi(img):
-    """Расчет NDVI индекса"""
-    ndvi = img.normalizedDifference(['B8', 'B4']).rename('NDVI')
-    return img.addBands(ndvi)
-
-def calculate_ndwi(img):
-    """Расчет NDWI индекса"""
-    ndwi = img.normalizedDifference(['B3', 'B8']).rename('NDWI')
-    return img.addBands(ndwi)
+    
+    start_date = params.start_date
+    end_date = params.end_date
+    
+    if params.snap_dates:
+        start_date -= timedelta(days=start_date.weekday())
+        end_date += timedelta(days=(7 - end_date.weekday()) % 7)
+    
+    # Конец не включается: перевернутый или пустой период не содержит снимков
+    if start_date >= end_date:
+        raise msgspec.ValidationError(
+            f"Пустой период {start_date.isoformat()} - {end_date.isoformat()}"
+        )
+    
+    return bounds, start_date.isoformat(), end_date.isoformat()
+
+def tiles_cache_key(bounds, start_date, end_date, cloud_filter, enable_smoothing, layer_type, mosaic_method):
+    """Ключ кэша тайлов слоя (границы и даты уже приведены к сетке)"""
+    return (
+        'tiles',
+        tuple(bounds),
+        start_date,
+        end_date,
+        cloud_filter,
+        enable_smoothing,
+        layer_type,
+        mosaic_method
+    )
+
+def multiband_cache_key(bounds, start_date, end_date, cloud_filter, enable_smoothing, mosaic_method):
+    """Ключ кэша общей мозаики всех слоев"""
+    return (
+        'multiband',
+        tuple(bounds),
+        start_date,
+        end_date,
+        cloud_filter,
+        enable_smoothing,
+        mosaic_method
+    )
+
+def stats_cache_key(bounds, start_date, end_date, cloud_filter):
+    """Ключ кэша количества снимков и периода съемки"""
+    return (
+        'stats',
+        tuple(bounds),
+        start_date,
+        end_date,
+        cloud_filter
+    )
+
+def public_tile_url(result):
+    """URL тайлов для клиента: напрямую в Earth Engine или через наш прокси"""
+    if TILE_PROXY:
+        base_url = TILE_PROXY_BASE_URL or request.host_url.rstrip("/")
+        return f"{base_url}/tiles/{result['map_id']}/{{z}}/{{x}}/{{y}}"
+    return result['tile_url']
+
+def ojsonify(payload):
+    """JSON-ответ через orjson (быстрее стандартного jsonify)"""
+    return app.response_class(orjson.dumps(payload), mimetype='application/json')
+
+@app.errorhandler(msgspec.DecodeError)
+def handle_bad_request(e):
+    """Некорректный запрос - отвечаем сразу, без трассировки"""
+    logger.warning("⚠️ Некорректный запрос: %s", e)
+    return ojsonify({
+        'success': False,
+        'error': str(e)
+    }), 400
+
+@app.errorhandler(requests.exceptions.Timeout)
+@app.errorhandler(socket.timeout)
+@app.errorhandler(FutureTimeout)
+def handle_ee_timeout(e):
+    """Earth Engine не ответил за EE_TIMEOUT"""
+    logger.warning("⏱️ Earth Engine не ответил за %s сек", EE_TIMEOUT)
+    return ojsonify({
+        'success': False,
+        'error': 'Earth Engine request timed out'
+    }), 504
+
+@app.errorhandler(Exception)
+def handle_error(e):
+    """Прочие ошибки: трассировку собираем только в режиме отладки"""
+    # HTTP-ошибки Flask (404, 405, ...) отдаем как есть
+    if isinstance(e, HTTPException):
+        return e
+    
+    logger.error("❌ Ошибка: %s", e, exc_info=logger.isEnabledFor(logging.DEBUG))
+    return ojsonify({
+        'success': False,
+        'error': str(e)
+    }), 500
 
 @app.route('/')
 def index():
     """Главная страница - отдаем наш HTML"""
     return render_template('index.html')
 
-@app.route('/api/get_sentinel_image', methods=['POST'])
-def get_sentinel_image():
-    """API для получения спутникового снимка"""
-    try:
-        # Получаем параметры из запроса
-        data = request.json
-        bounds = data['bounds']
-        geometry = ee.Geometry.Rectangle(bounds)
-        start_date = data['start_date']
-        end_date = data['end_date']
-        cloud_filter = data.get('cloud_filter', 30)
-        enable_smoothing = data.get('smoothing', True)
-        layer_type = data.get('layer', 'TRUE_COLOR')
-        
-        print(f"📡 Запрос снимка: {start_date} - {end_date}, облачность < {cloud_filter}%, слой: {layer_type}")
+def cache_get(key):
+    """Получение значения из кэша (None если нет или устарело)"""
+    with _tile_cache_lock:
+        entry = _tile_cache.get(key)
+        if entry is None:
+            return None
         
-        # Конфигурация для разных типов слоев
-        band_configs = {
-            'TRUE_COLOR': {
-                'bands': ['B4', 'B3', 'B2'], 
-                'min': '0,0,0', 
-                'max': '3000,3000,3000',
-                'description': 'Настоящие цвета (RGB)'
-            },
-            'FALSE_COLOR': {
-                'bands': ['B8', 'B4', 'B3'], 
-                'min': '0,0,0', 
-                'max': '3000,3000,3000',
-                'description': 'Ложные цвета'
-            },
-            'NDVI': {
-                'bands': ['NDVI'], 
-                'min': '-1', 
-                'max': '1',
-                'palette': ['red', 'yellow', 'green'],
-                'description': 'NDVI - Вегетационный индекс'
-            },
-            'NDWI': {
-                'bands': ['NDWI'], 
-                'min': '-1', 
-                'max': '1', 
-                'palette': ['white', 'blue'],
-                'description': 'NDWI - Водный индекс'
-            }
-        }
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del _tile_cache[key]
+            return None
         
-        config = band_configs.get(layer_type, band_configs['TRUE_COLOR'])
+        _tile_cache.move_to_end(key)
+        return value
+
+def cache_put(key, value):
+    """Сохранение значения в кэш с вытеснением самых старых записей"""
+    with _tile_cache_lock:
+        _tile_cache[key] = (time.monotonic() + TILE_CACHE_TTL, value)
+        _tile_cache.move_to_end(key)
+        while len(_tile_cache) > TILE_CACHE_SIZE:
+            _tile_cache.popitem(last=False)
+
+def run_single_flight(key, func, *args, use_cache=True):
+    """Выполнение запроса к Earth Engine в потоке текущего запроса
+    
+    Одинаковые параллельные запросы не дублируются: первый выполняет
+    func и кладет результат в кэш, остальные ждут его результат.
+    Время ожидания ограничено таймаутом HTTP-запросов к Earth Engine.
+    """
+    with _inflight_lock:
+        # Повторная проверка кэша под блокировкой: запрос мог завершиться
+        # между промахом кэша во view и этой точкой
+        if use_cache:
+            cached = cache_get(key)
+            if cached is not None:
+                return cached
         
-        # Формируем коллекцию снимков
-        collection = (
-            ee.ImageCollection("COPERNICUS/S2_SR_HARMONIZED")
-            .filterDate(start_date, end_date)
-            .filterBounds(geometry)
-            .filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', cloud_filter))
+        future = _inflight.get(key)
+        is_owner = future is None
+        if is_owner:
+            future = Future()
+            _inflight[key] = future
+    
+    if not is_owner:
+        return future.result(timeout=EE_TIMEOUT)
+    
+    try:
+        result = func(*args)
+    except BaseException as e:
+        with _inflight_lock:
+            del _inflight[key]
+        future.set_exception(e)
+        raise
+    
+    # Сначала кэш, затем снятие: запрос между ними не запустит вычисление повторно
+    cache_put(key, result)
+    with _inflight_lock:
+        del _inflight[key]
+    future.set_result(result)
+    return result
+
+@app.route('/api/get_sentinel_image', methods=['POST'])
+def get_sentinel_image():
+    """API для получения спутникового снимка"""
+    # Получаем параметры из запроса
+    params = msgspec.json.decode(request.get_data(), type=TileRequest)
+    bounds, start_date, end_date = normalize_selection(params)
+    cloud_filter = params.cloud_filter
+    enable_smoothing = params.smoothing
+    layer_type = params.layer
+    mosaic_method = params.mosaic_method
+    
+    logger.info(
+        "📡 Запрос снимка: %s - %s, облачность < %s%%, слой: %s, мозаика: %s",
+        start_date, end_date, cloud_filter, layer_type, mosaic_method
+    )
+    
+    cache_key = tiles_cache_key(
+        bounds, start_date, end_date, cloud_filter, enable_smoothing, layer_type, mosaic_method
+    )
+    
+    result = None if params.nocache else cache_get(cache_key)
+    if result is None:
+        result = run_single_flight(
+            cache_key, build_tiles, bounds, start_date, end_date, cloud_filter, enable_smoothing, layer_type, mosaic_method,
+            use_cache=not params.nocache
         )
-        
-        # Добавляем вычисление индексов если нужно
-        if layer_type == 'NDVI':
-            collection = collection.map(calculate_ndvi)
-        elif layer_type == 'NDWI':
-            collection = collection.map(calculate_ndwi)
-        
-        # Применяем маскировку облаков если включено сглаживание
-        if enable_smoothing:
-            collection = collection.map(mask_clouds)
-        
-        # Создаем мозаику
-        mosaic = collection.median()
-        
-        # Формируем параметры для визуализации
-        vis_params = {
-            "bands": config['bands'],
-            "min": config.get('min', '0'),
-            "max": config.get('max', '3000'),
-            "region": geometry
+        logger.info("✅ Успешно: тайлы сформированы")
+    else:
+        logger.debug("⚡ Тайлы из кэша")
+    
+    response = ojsonify({
+        'success': True,
+        'tile_url': public_tile_url(result),
+        'period': {'start': start_date, 'end': end_date},
+        'layer_info': {
+            'type': layer_type,
+            'description': result['description']
         }
+    })
+    response.headers['Cache-Control'] = API_CACHE_CONTROL
+    return response
+
+@app.route('/api/get_sentinel_multiband', methods=['POST'])
+def get_sentinel_multiband():
+    """API для получения тайлов всех слоев по одной мозаике
+    
+    Страница сначала показывает выбранный слой через get_sentinel_image,
+    а этот запрос делает в фоне, чтобы переключать слои без ожидания.
+    Тайлы слоев попадают и в кэш get_sentinel_image.
+    """
+    params = msgspec.json.decode(request.get_data(), type=MosaicRequest)
+    bounds, start_date, end_date = normalize_selection(params)
+    cloud_filter = params.cloud_filter
+    enable_smoothing = params.smoothing
+    mosaic_method = params.mosaic_method
+    
+    logger.info(
+        "📡 Запрос всех слоев: %s - %s, облачность < %s%%, мозаика: %s",
+        start_date, end_date, cloud_filter, mosaic_method
+    )
+    
+    cache_key = multiband_cache_key(
+        bounds, start_date, end_date, cloud_filter, enable_smoothing, mosaic_method
+    )
+    
+    layers = None if params.nocache else cache_get(cache_key)
+    if layers is None:
+        layers = run_single_flight(
+            cache_key, build_multiband_tiles, bounds, start_date, end_date, cloud_filter, enable_smoothing, mosaic_method,
+            use_cache=not params.nocache
+        )
         
-        # Добавляем палитру для индексов
-        if 'palette' in config:
-            vis_params["palette"] = config['palette']
-        
-        # Получаем URL для тайлов
-        tile_info = ee.data.getMapId({
-            "image": mosaic,
-            **vis_params
-        })
-        
-        # Формируем URL для тайлов
-        map_id = tile_info["mapid"]
-        tile_url = f"https://earthengine.googleapis.com/v1/maps/{map_id}/tiles/{{z}}/{{x}}/{{y}}"
-        
-        image_count = collection.size().getInfo()
-        
-        print(f"✅ Успешно: найдено {image_count} снимков")
-        
-        return jsonify({
-            'success': True,
-            'tile_url': tile_url,
-            'image_count': image_count,
-            'layer_info': {
-                'type': layer_type,
-                'description': config['description']
+        # Одиночные запросы слоев с теми же параметрами берут готовый mapid
+        for layer_type, result in layers.items():
+            cache_put(tiles_cache_key(
+                bounds, start_date, end_date, cloud_filter, enable_smoothing, layer_type, mosaic_method
+            ), result)
+        logger.info("✅ Успешно: сформировано слоев - %s", len(layers))
+    else:
+        logger.debug("⚡ Слои из кэша")
+    
+    response = ojsonify({
+        'success': True,
+        'period': {'start': start_date, 'end': end_date},
+        'layers': {
+            layer_type: {
+                'tile_url': public_tile_url(result),
+                'description': result['description']
             }
-        })
+            for layer_type, result in layers.items()
+        }
+    })
+    response.headers['Cache-Control'] = API_CACHE_CONTROL
+    return response
+
+@app.route('/api/image_count', methods=['POST'])
+def get_image_count():
+    """API для подсчета снимков и периода съемки (вызывается параллельно с get_sentinel_image)"""
+    params = msgspec.json.decode(request.get_data(), type=ImageStatsRequest)
+    bounds, start_date, end_date = normalize_selection(params)
+    cloud_filter = params.cloud_filter
+    
+    cache_key = stats_cache_key(bounds, start_date, end_date, cloud_filter)
+    
+    stats = None if params.nocache else cache_get(cache_key)
+    if stats is None:
+        stats = run_single_flight(
+            cache_key, image_stats, bounds, start_date, end_date, cloud_filter,
+            use_cache=not params.nocache
+        )
+    
+    logger.info("✅ Найдено %s снимков", stats['image_count'])
+    
+    return ojsonify({
+        'success': True,
+        'image_count': stats['image_count'],
+        'date_range': stats['date_range'],
+        'period': {'start': start_date, 'end': end_date}
+    })
+
+class MapIdConverter(BaseConverter):
+    """Идентификатор карты Earth Engine: projects/<проект>/maps/<id>"""
+    regex = r"projects/[a-z][a-z0-9-]*/maps/[A-Za-z0-9_-]+"
+
+app.url_map.converters['mapid'] = MapIdConverter
+
+def proxy_tile(map_id, z, x, y):
+    """Проксирование тайла Earth Engine с HTTP-кэшированием"""
+    try:
+        upstream = _tile_session.get(
+            f"{EE_TILES_BASE}/{map_id}/tiles/{z}/{x}/{y}",
+            stream=True,
+            timeout=EE_TIMEOUT
+        )
+    except requests.RequestException as e:
+        logger.warning("⚠️ Тайл недоступен: %s", e)
+        return Response(status=502)
+    
+    if upstream.status_code != 200:
+        upstream.close()
+        return Response(status=upstream.status_code)
+    
+    response = Response(
+        upstream.iter_content(chunk_size=8192),
+        content_type=upstream.headers.get('Content-Type', 'image/png')
+    )
+    response.headers['Cache-Control'] = TILE_CACHE_CONTROL
+    response.call_on_close(upstream.close)
+    return response
+
+# Прокси доступен только при включенном TILE_PROXY
+if TILE_PROXY:
+    app.add_url_rule('/tiles/<mapid:map_id>/<int:z>/<int:x>/<int:y>', view_func=proxy_tile)
+
+# Готовые тела ответов health check для обоих состояний Earth Engine
+_HEALTH_BODIES = {
+    initialized: orjson.dumps({
+        'status': 'healthy',
+        'service': 'KrusGis Sentinel API',
+        'gee_initialized': initialized
+    })
+    for initialized in (True, False)
+}
+
+_HEALTH_PATHS = frozenset(('/api/health', '/health'))
+
+class HealthCheckMiddleware:
+    """WSGI-обертка: health check отвечает до маршрутизации Flask"""
+    
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+    
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') not in _HEALTH_PATHS:
+            return self.wsgi_app(environ, start_response)
         
-    except Exception as e:
-        error_msg = f"❌ Ошибка: {str(e)}"
-        print(error_msg)
-        traceback.print_exc()
-        return jsonify({
-            'success': False,
-            'error': str(e)
-        }), 500
-
-@app.route('/api/health')
-def health_check():
-    """Health check endpoint"""
-    return jsonify({
-        'status': 'healthy', 
+        body = _HEALTH_BODIES[bool(ee.data._initialized)]
+        start_response('200 OK', [
+            ('Content-Type', 'application/json'),
+            ('Content-Length', str(len(body)))
+        ])
+        return [body]
+
+app.wsgi_app = HealthCheckMiddleware(app.wsgi_app)
+
+@app.route('/debug/info')
+def debug_info():
+    """Служебная информация (время сервера вынесено из health check)"""
+    return ojsonify({
         'service': 'KrusGis Sentinel API',
         'gee_initialized': ee.data._initialized,
         'timestamp': datetime.now().isoformat()
     })
 
 # Инициализируем Earth Engine при старте приложения
-if initialize_earth_engine():
-    print("✅ Приложение готово к работе")
+if initialize_earth_engine(EE_TIMEOUT, TILE_POOL_SIZE):
+    logger.info("✅ Приложение готово к работе")
 else:
-    print("❌ Приложение не может работать без Earth Engine")
+    logger.error("❌ Приложение не может работать без Earth Engine")
 
 if __name__ == "__main__":
-    print("🚀 Запуск KrusGis Sentinel API...")
+    logger.info("🚀 Запуск KrusGis Sentinel API...")
     app.run(
         host='0.0.0.0', 
         port=int(os.environ.get("PORT", 5000)), 
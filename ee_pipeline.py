@@ -0,0 +1,294 @@
+# Построение мозаик Sentinel-2 в Earth Engine (общее ядро, без зависимости от Flask)
+import ee
+import httplib2
+import json
+import logging
+import os
+import requests
+from datetime import datetime, timezone
+from requests.adapters import HTTPAdapter
+from types import MappingProxyType
+
+logger = logging.getLogger("krusgis")
+
+# Credentials Earth Engine (читаются из окружения при первой инициализации)
+_GEE_KEY_STR = None
+_SERVICE_ACCOUNT_INFO = None
+
+# Базовый адрес тайлов Earth Engine
+EE_TILES_BASE = "https://earthengine.googleapis.com/v1/maps"
+
+# Коллекция CloudScore+ для композита по качеству пикселя
+CLOUD_SCORE_COLLECTION = "GOOGLE/CLOUD_SCORE_PLUS/V1/S2_HARMONIZED"
+
+# Методы сведения коллекции в мозаику (см. build_mosaic)
+MOSAIC_METHODS = ('median', 'quality', 'first_valid')
+
+# Конфигурация для разных типов слоев (только для чтения).
+# source_bands - каналы Sentinel-2, необходимые для построения слоя
+BAND_CONFIGS = MappingProxyType({
+    'TRUE_COLOR': MappingProxyType({
+        'bands': ['B4', 'B3', 'B2'], 
+        'source_bands': ['B4', 'B3', 'B2'],
+        'min': '0,0,0', 
+        'max': '3000,3000,3000',
+        'description': 'Настоящие цвета (RGB)'
+    }),
+    'FALSE_COLOR': MappingProxyType({
+        'bands': ['B8', 'B4', 'B3'], 
+        'source_bands': ['B8', 'B4', 'B3'],
+        'min': '0,0,0', 
+        'max': '3000,3000,3000',
+        'description': 'Ложные цвета'
+    }),
+    'NDVI': MappingProxyType({
+        'bands': ['NDVI'], 
+        'source_bands': ['B8', 'B4'],
+        'min': '-1', 
+        'max': '1',
+        'palette': ['red', 'yellow', 'green'],
+        'description': 'NDVI - Вегетационный индекс'
+    }),
+    'NDWI': MappingProxyType({
+        'bands': ['NDWI'], 
+        'source_bands': ['B3', 'B8'],
+        'min': '-1', 
+        'max': '1', 
+        'palette': ['white', 'blue'],
+        'description': 'NDWI - Водный индекс'
+    })
+})
+
+class PooledHttp:
+    """HTTP-транспорт Earth Engine с общим пулом соединений
+
+    Повторяет интерфейс httplib2.Http.request, как и встроенный транспорт
+    Earth Engine, но не открывает новую requests.Session на каждый вызов:
+    TLS-соединения переиспользуются между запросами и потоками.
+    """
+
+    def __init__(self, timeout=None, pool_size=10):
+        self._timeout = timeout
+        self._session = requests.Session()
+        self._session.mount("https://", HTTPAdapter(pool_maxsize=pool_size))
+
+    def request(self, uri, method='GET', body=None, headers=None,
+                redirections=None, connection_type=None):
+        """Запрос в семантике httplib2: (httplib2.Response, content)"""
+        response = self._session.request(
+            method, uri, data=body, headers=headers, timeout=self._timeout)
+        response_headers = dict(response.headers)
+        response_headers['status'] = response.status_code
+        return httplib2.Response(response_headers), response.content
+
+def initialize_earth_engine(timeout=None, pool_size=10):
+    """Инициализация Earth Engine
+    
+    timeout - таймаут HTTP-запросов (сек), pool_size - число соединений
+    в пуле (по числу одновременных запросов воркера)
+    """
+    global _GEE_KEY_STR, _SERVICE_ACCOUNT_INFO
+    
+    try:
+        logger.info("🔄 Инициализация Earth Engine...")
+        
+        # Парсим JSON credentials (один раз на процесс)
+        if _SERVICE_ACCOUNT_INFO is None:
+            # Получаем credentials из переменных окружения (GitHub Secrets)
+            gee_credentials = os.environ.get("GEE_CREDENTIALS")
+            
+            if not gee_credentials:
+                raise ValueError("GEE_CREDENTIALS не найдены в переменных окружения")
+            
+            _SERVICE_ACCOUNT_INFO = json.loads(gee_credentials)
+            _GEE_KEY_STR = gee_credentials
+        
+        # Создаем credentials для Earth Engine (ключ передаем исходной строкой)
+        credentials = ee.ServiceAccountCredentials(
+            _SERVICE_ACCOUNT_INFO["client_email"],
+            key_data=_GEE_KEY_STR
+        )
+        
+        # Инициализируем Earth Engine. При своем транспорте setDeadline
+        # не действует - таймаут применяет сам PooledHttp
+        ee.Initialize(
+            credentials,
+            http_transport=PooledHttp(timeout or None, pool_size)
+        )
+        logger.info("✅ Earth Engine инициализирован")
+        return True
+        
+    except Exception as e:
+        logger.error("❌ Ошибка инициализации Earth Engine: %s", e)
+        return False
+
+def mask_clouds(img):
+    """Маскировка облаков"""
+    scl = img.select("SCL")
+    # Классы SCL 4-7 (растительность, почва, вода, неклассифицированные) - одним диапазоном
+    allowed = scl.gte(4).And(scl.lte(7))
+    return img.updateMask(allowed).resample("bilinear")
+
+def calculate_ndvi(img):
+    """Расчет NDVI индекса"""
+    ndvi = img.normalizedDifference(['B8', 'B4']).rename('NDVI')
+    return img.addBands(ndvi)
+
+def calculate_ndwi(img):
+    """Расчет NDWI индекса"""
+    ndwi = img.normalizedDifference(['B3', 'B8']).rename('NDWI')
+    return img.addBands(ndwi)
+
+def build_collection(geometry, start_date, end_date, cloud_filter):
+    """Коллекция снимков Sentinel-2 за период с фильтром облачности"""
+    return (
+        ee.ImageCollection("COPERNICUS/S2_SR_HARMONIZED")
+        .filterDate(start_date, end_date)
+        .filterBounds(geometry)
+        .filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', cloud_filter))
+    )
+
+def build_mosaic(collection, mosaic_method):
+    """Сведение коллекции в один снимок выбранным методом
+    
+    median      - медиана по всем снимкам (по умолчанию)
+    quality     - лучший пиксель по CloudScore+ (cs_cdf)
+    first_valid - наименее облачный снимок поверх остальных
+    """
+    if mosaic_method == 'quality':
+        return collection.qualityMosaic('cs_cdf')
+    if mosaic_method == 'first_valid':
+        # mosaic() кладет последний снимок сверху - сортируем по убыванию облачности
+        return collection.sort('CLOUDY_PIXEL_PERCENTAGE', False).mosaic()
+    return collection.median()
+
+def build_composite(geometry, start_date, end_date, cloud_filter, source_bands, enable_smoothing, mosaic_method):
+    """Мозаика из выбранных каналов Sentinel-2 (без индексов)"""
+    # Формируем коллекцию снимков
+    collection = build_collection(geometry, start_date, end_date, cloud_filter)
+    
+    # Мозаика из первого подходящего снимка требует строгой маскировки облаков
+    apply_mask = enable_smoothing or mosaic_method == 'first_valid'
+    
+    # Каналы, которые попадают в мозаику (cs_cdf - ранг для qualityMosaic)
+    mosaic_bands = list(source_bands)
+    if mosaic_method == 'quality':
+        mosaic_bands.append('cs_cdf')
+    
+    # Оставляем только нужные каналы (SCL - для маскировки облаков)
+    collection = collection.select(
+        list(source_bands) + ['SCL'] if apply_mask else list(source_bands)
+    )
+    
+    # Присоединяем оценку облачности CloudScore+ к каждому снимку
+    if mosaic_method == 'quality':
+        collection = collection.linkCollection(
+            ee.ImageCollection(CLOUD_SCORE_COLLECTION), ['cs_cdf']
+        )
+    
+    # Применяем маскировку облаков и убираем SCL до сведения в мозаику
+    if apply_mask:
+        collection = collection.map(mask_clouds).select(mosaic_bands)
+    
+    # Создаем мозаику
+    return build_mosaic(collection, mosaic_method)
+
+def get_layer_tiles(mosaic, config, geometry):
+    """Получение URL тайлов мозаики для одного слоя"""
+    # Формируем параметры для визуализации
+    vis_params = {
+        "bands": config['bands'],
+        "min": config.get('min', '0'),
+        "max": config.get('max', '3000'),
+        "region": geometry
+    }
+    
+    # Добавляем палитру для индексов
+    if 'palette' in config:
+        vis_params["palette"] = config['palette']
+    
+    # Получаем URL для тайлов
+    tile_info = ee.data.getMapId({
+        "image": mosaic,
+        **vis_params
+    })
+    
+    # Формируем URL для тайлов
+    map_id = tile_info["mapid"]
+    tile_url = f"{EE_TILES_BASE}/{map_id}/tiles/{{z}}/{{x}}/{{y}}"
+    
+    return {
+        'map_id': map_id,
+        'tile_url': tile_url,
+        'description': config['description']
+    }
+
+def build_tiles(bounds, start_date, end_date, cloud_filter, enable_smoothing, layer_type, mosaic_method='median'):
+    """Построение мозаики в Earth Engine и получение URL тайлов"""
+    geometry = ee.Geometry.Rectangle(bounds)
+    
+    config = BAND_CONFIGS.get(layer_type, BAND_CONFIGS['TRUE_COLOR'])
+    
+    mosaic = build_composite(
+        geometry, start_date, end_date, cloud_filter,
+        config['source_bands'], enable_smoothing, mosaic_method
+    )
+    
+    # Индексы считаем один раз по мозаике, а не по каждому снимку
+    if layer_type == 'NDVI':
+        mosaic = calculate_ndvi(mosaic)
+    elif layer_type == 'NDWI':
+        mosaic = calculate_ndwi(mosaic)
+    
+    return get_layer_tiles(mosaic, config, geometry)
+
+def build_multiband_tiles(bounds, start_date, end_date, cloud_filter, enable_smoothing, mosaic_method='median'):
+    """URL тайлов для всех слоев по одной общей мозаике
+    
+    Мозаика строится один раз со всеми каналами и обоими индексами,
+    слои отличаются только параметрами визуализации в getMapId.
+    """
+    geometry = ee.Geometry.Rectangle(bounds)
+    
+    source_bands = sorted({
+        band for config in BAND_CONFIGS.values() for band in config['source_bands']
+    })
+    
+    mosaic = build_composite(
+        geometry, start_date, end_date, cloud_filter,
+        source_bands, enable_smoothing, mosaic_method
+    )
+    mosaic = calculate_ndwi(calculate_ndvi(mosaic))
+    
+    return {
+        layer_type: get_layer_tiles(mosaic, config, geometry)
+        for layer_type, config in BAND_CONFIGS.items()
+    }
+
+def image_stats(bounds, start_date, end_date, cloud_filter):
+    """Количество снимков и период съемки - одним запросом к Earth Engine"""
+    geometry = ee.Geometry.Rectangle(bounds)
+    collection = build_collection(geometry, start_date, end_date, cloud_filter)
+    
+    stats = ee.Dictionary({
+        'count': collection.size(),
+        'first': collection.aggregate_min('system:time_start'),
+        'last': collection.aggregate_max('system:time_start')
+    }).getInfo()
+    
+    # Для пустой коллекции даты не определены
+    date_range = None
+    if stats['count']:
+        date_range = {
+            'first': _format_timestamp(stats['first']),
+            'last': _format_timestamp(stats['last'])
+        }
+    
+    return {
+        'image_count': stats['count'],
+        'date_range': date_range
+    }
+
+def _format_timestamp(millis):
+    """Перевод system:time_start (мс) в дату YYYY-MM-DD"""
+    return datetime.fromtimestamp(millis / 1000, tz=timezone.utc).strftime('%Y-%m-%d')
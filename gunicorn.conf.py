@@ -0,0 +1,23 @@
+# Конфигурация gunicorn для продакшена: gunicorn -c gunicorn.conf.py app:app
+import multiprocessing
+import os
+
+# Воркер gevent сам подменяет сокеты и потоки до загрузки приложения,
+# поэтому запросы Earth Engine (requests) не блокируют его
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gevent")
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get("GUNICORN_WORKERS", multiprocessing.cpu_count()))
+
+# Потоков на воркер для gthread. Это же значение приложение берет
+# для пулов соединений к Earth Engine и прокси тайлов
+threads = int(os.environ.get("WORKER_CONCURRENCY", 32))
+
+# Лимит клиентских соединений на воркер gevent. Задается отдельно:
+# простаивающие keep-alive соединения тоже занимают слоты (гринлеты
+# дешевые), поэтому лимит заметно выше числа активных запросов
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 200))
+
+# Держим соединения с балансировщиком открытыми между запросами
+keepalive = 75
+timeout = 120